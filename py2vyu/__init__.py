@@ -1,2 +1,2 @@
 name = "py2vyu"
-from py2vyu import *
+from .py2vyu import *
@@ -1,53 +1,138 @@
 from __future__ import print_function
-import future
+import io
 import zipfile
 import re
-import pandas as pd
+import numpy as np
 import numbers
+from array import array
+from collections import namedtuple
 from math import floor
-import builtins
-import past
-import six
 import tempfile
 import os
 
+try:
+    _TIME_TYPECODE = array("q").typecode
+except ValueError:  # Python 2 has no "q" typecode
+    _TIME_TYPECODE = "l"
 
-_line_formats = {
-    "column": re.compile(r"(?P<colname>\w+)\s\(.*\)\-(?P<codes>.*)"),
-    "cell": re.compile(
-        r"(?P<onset>\d{2}\:\d{2}\:\d{2}\:\d{3}),"
-        r"(?P<offset>\d{2}\:\d{2}\:\d{2}\:\d{3}),"
-        r"\((?P<values>.*)\)"
-    ),
-}
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit when numba is not installed."""
+
+        def decorator(func):
+            return func
+
+        return decorator
+
+
+# Column names are ASCII identifiers (re.ASCII is the default on Python 2)
+_COL_RE = re.compile(
+    r"\A(?P<colname>\w+)\s\([^)]*\)-(?P<codes>.*)\Z", getattr(re, "ASCII", 0)
+)
+
+
+class _CellMatch(namedtuple("_CellMatch", ["onset", "offset", "values"])):
+    """Fields of a sliced cell line, exposing the same group() as a regex match."""
+
+    __slots__ = ()
+
+    def group(self, name):
+        return getattr(self, name)
+
+
+_DIGITS = frozenset("0123456789")
+
+
+def _is_timestamp(text):
+    """True if text is an HH:MM:SS:mmm timestamp made of ASCII digits."""
+    return text[2] == text[5] == text[8] == ":" and _DIGITS.issuperset(
+        text[0:2] + text[3:5] + text[6:8] + text[9:12]
+    )
+
+
+def _slice_cell(line):
+    """
+    Split a cell line of the form HH:MM:SS:mmm,HH:MM:SS:mmm,(values) by position.
+    Returns None if the line does not have that layout.
+    """
+
+    if (
+        len(line) > 27
+        and line[12] == ","
+        and line[25:27] == ",("
+        and line[-1] == ")"
+        and _is_timestamp(line[0:12])
+        and _is_timestamp(line[13:25])
+    ):
+        return _CellMatch(line[0:12], line[13:25], line[27:-1])
+    return None
 
 
 def _parse_line(line):
-    for key, rx in _line_formats.items():
-        match = rx.search(line)
-        if match:
-            return key, match
+    # Cell lines vastly outnumber column lines, so try them first.
+    match = _slice_cell(line)
+    if match:
+        return "cell", match
+    match = _COL_RE.match(line)
+    if match:
+        return "column", match
 
     return None, None
 
 
+@njit(cache=True)
+def _assign_cells(times, onsets, offsets):
+    """
+    Index of the cell spanning each time point, or -1 if none does.
+    onsets and offsets must be sorted by onset and non-overlapping.
+    """
+
+    idx = np.searchsorted(onsets, times, side="right") - 1
+    spanned = (idx >= 0) & (offsets[np.maximum(idx, 0)] >= times)
+    return np.where(spanned, idx, -1)
+
+
+def _cells_at_times(col, times):
+    """Cells of col spanning each time point in times (None where there is none)."""
+
+    col._build_index()
+
+    # Overlapping cells need first-match semantics, so scan those columns.
+    if len(col.cells) == 0 or col._overlapping:
+        return [col.cell_at(t) for t in times]
+
+    idx = _assign_cells(
+        np.asarray(times, dtype=np.int64), col._onsets_arr, col._offsets_arr
+    )
+    return [col._sorted_cells[i] if i >= 0 else None for i in idx.tolist()]
+
+
 def load_opf(filename):
     """Extract data from a .opf file and return a Spreadsheet"""
 
-    with zipfile.ZipFile(filename, "r") as zf:
+    with zipfile.ZipFile(filename, "r", allowZip64=True) as zf:
         assert "db" in zf.namelist()
 
-        # Open the db file
+        # Open the db file, decoding it in large buffered chunks
         with zf.open("db") as db:
+            # Split on "\n" only, like iterating the raw bytes; values may hold "\r"
+            db = io.TextIOWrapper(
+                io.BufferedReader(db, 64 * 1024), encoding="utf8", newline="\n"
+            )
             sheet = Spreadsheet()
             col = None
             ordinal_counter = 1
+            pending = []  # (column, ordinal, onset, offset, values) per cell
 
             for line_num, line in enumerate(db):
-                line_stripped = line.strip().decode("utf8")
-
                 # Check type of line
-                line_type, match = _parse_line(line_stripped)
+                line_type, match = _parse_line(line.rstrip("\r\n"))
+                if line_type is None:
+                    # Tolerate stray whitespace around a line
+                    line_type, match = _parse_line(line.strip())
                 if line_type == "column":
                     codes = [x.split("|")[0] for x in match.group("codes").split(",")]
 
@@ -57,14 +142,27 @@ def load_opf(filename):
                     ordinal_counter = 1
 
                 elif line_type == "cell":
-                    values = match.group("values").split(",")
-                    cell = col.new_cell(
-                        ordinal=ordinal_counter,
-                        onset=to_millis(match.group("onset")),
-                        offset=to_millis(match.group("offset")),
-                        *values
+                    pending.append(
+                        (
+                            col,
+                            ordinal_counter,
+                            match.group("onset"),
+                            match.group("offset"),
+                            match.group("values"),
+                        )
                     )
                     ordinal_counter += 1
+
+    # Convert all timestamps at once, then build the cells
+    onsets = to_millis_bulk([p[2] for p in pending]).tolist()
+    offsets = to_millis_bulk([p[3] for p in pending]).tolist()
+    for (col, ordinal, _, _, values), onset, offset in zip(pending, onsets, offsets):
+        cell = Cell._new_fast(col, ordinal, onset, offset)
+        values = values.split(",")[: len(cell.values)]
+        cell.values[: len(values)] = values
+        col.cells.append(cell)
+        col._dirty = True
+
     return sheet
 
 
@@ -92,14 +190,14 @@ def save_opf(sheet, filename, *columns):
         zf.writestr("db", "#4\n" + sheet._to_opfdb(columns=columns))
 
 
-class Spreadsheet:
+class Spreadsheet(object):
     """Collection of columns."""
 
-    name = ""
-    columns = {}
+    __slots__ = ("columns", "name")
 
     def __init__(self):
-        pass
+        self.columns = {}
+        self.name = ""
 
     def new_column(self, name, *codes):
         ncol = Column(name, *codes)
@@ -139,65 +237,80 @@ class Spreadsheet:
         ]
         ncol = Column(name, *codes)
 
-        # Get a list of unique timestamps across all cells
-        all_cells = [cell for col in cols for cell in col.cells]
-        unique_times = list(
-            dict.fromkeys(
-                [time for cell in all_cells for time in [cell.onset, cell.offset]]
-            )
-        )
-
-        # Get times of point cells (onset == offset)
-        point_times = list(
-            dict.fromkeys(
-                [
-                    cell.onset
-                    for cell in filter(lambda x: x.onset == x.offset, all_cells)
-                ]
-            )
-        )
-
-        times = sorted(
-            set(unique_times + [x + 1 for x in point_times])
-        )  # this should put a time 1 ms after each of the point times
+        # Get the sorted unique timestamps across all cells, plus a time 1 ms
+        # after each point cell (onset == offset)
+        boundaries = []
+        for col in cols:
+            col._build_index()
+            onsets, offsets = col._onsets_arr, col._offsets_arr
+            boundaries.extend((onsets, offsets, onsets[onsets == offsets] + 1))
+        times = np.unique(np.concatenate(boundaries))
+
+        # Look up the cell of each column spanning the start of every interval
+        interval_onsets = np.concatenate([times[:1], times[1:-1] + 1])
+        col_cells = [_cells_at_times(col, interval_onsets) for col in cols]
+        times = times.tolist()
+        interval_onsets = interval_onsets.tolist()
+
+        # Span of each column's ordinal and codes in the merged values list
+        col_spans = []
+        start = 0
+        for col in cols:
+            end = start + 1 + len(col.codelist)
+            col_spans.append((start, end))
+            start = end
 
         # Iterate over each interval and generate row of values for that interval
         ordinal = 1
-        prev_time = times[0]
-        for time in times[1:]:
-            onset = prev_time
+        for i, time in enumerate(times[1:]):
+            onset = interval_onsets[i]
             offset = time
-            ncell = ncol.new_cell(ordinal=ordinal, onset=onset, offset=offset)
+            ncell = Cell._new_fast(ncol, ordinal, onset, offset)
             valid_cells = 0  # num cols with data in interval
-            for col in cols:
-                cell = col.cell_at(onset)
+            values = ncell.values
+            for cells, (start, end) in zip(col_cells, col_spans):
+                cell = cells[i]
                 if cell is not None:
                     # Don't print point cells unless point region
                     if onset != offset and cell.onset == cell.offset:
                         continue
-                    for code in ["ordinal"] + col.codelist:
-                        ncell.change_code(col.name + "_" + code, cell.get_code(code))
+                    values[start] = cell.ordinal
+                    values[start + 1 : end] = cell.values
                     valid_cells += 1
-            ordinal += 1
-            prev_time = offset + 1
 
-            # Remove this cell if empty and we are pruning
+            # Only keep this cell if it has values or we are not pruning
             if prune and ncell.isempty():
-                ncol.cells.remove(ncell)
-                ordinal -= 1
+                # ncell holds the last slot of the time buffers; release it
+                ncol._onsets.pop()
+                ncol._offsets.pop()
+            else:
+                ncol.cells.append(ncell)
+                ordinal += 1
 
         return ncol
 
     def to_df(self, *columns):
         """Convert column set from this spreadsheet to a Pandas dataframe"""
 
+        import pandas as pd
+
         if len(columns) == 0:
             columns = self.columns.values()
 
-        merge_col = self.merge_columns("temp", *columns)
+        merge_col = self.merge_columns("temp", True, *columns)
+        cells = merge_col.sorted_cells()
+
+        # Build the frame column by column rather than row by row
+        idx = np.fromiter((c._idx for c in cells), np.intp, len(cells))
+        data = {
+            "ordinal": [c.ordinal for c in cells],
+            "onset": np.asarray(merge_col._onsets, dtype=np.int64)[idx],
+            "offset": np.asarray(merge_col._offsets, dtype=np.int64)[idx],
+        }
+        for i, code in enumerate(merge_col.codelist):
+            data[code] = [c.values[i] for c in cells]
 
         variable_list = ["ordinal", "onset", "offset"] + merge_col.codelist
-        data = [cell.get_values(intrinsics=True) for cell in merge_col.sorted_cells()]
         df = pd.DataFrame(data, columns=variable_list)
         df.set_index("ordinal", inplace=True)
         return df
@@ -208,7 +321,9 @@ class Spreadsheet:
         if len(columns) == 0:
             columns = self.columns.values()
 
-        return [val for cell in self.cells_at(time, *columns) for val in cell.values()]
+        return [
+            val for cell in self.cells_at(time, *columns) for val in cell.get_values()
+        ]
 
     def cells_at(self, time, *columns):
         """Find the cells spanning a time point."""
@@ -220,18 +335,57 @@ class Spreadsheet:
 
         return [col.cell_at(time) for col in cols]
 
-    def _to_opfdb(self, columns=columns.keys()):
+    def _to_opfdb(self, columns=None):
         """Converts to .opf compatible string."""
-        return "\n".join([self.columns[col]._to_opfdb() for col in columns])
+        if columns is None:
+            columns = self.columns.keys()
+
+        lines = []
+        for col in columns:
+            lines.extend(self.columns[col]._opfdb_lines())
+        return "\n".join(lines)
 
 
-class Column:
+class Column(object):
     """Representation of a Datavyu coding pass."""
 
+    __slots__ = (
+        "name",
+        "codelist",
+        "cells",
+        "_code_index",
+        "_onsets",
+        "_offsets",
+        "_sorted_cells",
+        "_onsets_arr",
+        "_offsets_arr",
+        "_overlapping",
+        "_dirty",
+        "_indexed_cells",
+        "_indexed_len",
+    )
+
     def __init__(self, name="", *codes):
         self.name = name
         self.codelist = list(codes)
         self.cells = []
+        self._code_index = {c: i for i, c in enumerate(self.codelist)}
+
+        # Onsets and offsets of all cells created for this column, indexed by
+        # Cell._idx
+        self._onsets = array(_TIME_TYPECODE)
+        self._offsets = array(_TIME_TYPECODE)
+
+        # Onset-sorted lookup arrays for cell_at, rebuilt when cells change.
+        # cells is public, so the list and its length at the last rebuild are
+        # kept to catch direct edits such as cells.remove().
+        self._sorted_cells = []
+        self._onsets_arr = None
+        self._offsets_arr = None
+        self._overlapping = False
+        self._dirty = True
+        self._indexed_cells = None
+        self._indexed_len = 0
 
     def new_cell(self, *values, **kwargs):
         """New cell with values in order of codelist, or defined as keyword args."""
@@ -243,11 +397,8 @@ class Column:
         for code, value in kwargs.items():
             c.change_code(code, value)
 
-        # Insert '' for undefined codes
-        for code in [x for x in self.codelist if not x in c.values.keys()]:
-            c.change_code(code, "")
-
         self.cells.append(c)
+        self._dirty = True
         return c
 
     def sorted_cells(self):
@@ -256,8 +407,44 @@ class Column:
     def cell_at(self, time):
         """Return a cell spanning a time point in this column, if any."""
 
-        cell = next((cell for cell in self.cells if cell.spans(time)), None)
-        return cell
+        self._build_index()
+        if self._overlapping:
+            return next((cell for cell in self.cells if cell.spans(time)), None)
+
+        idx = np.searchsorted(self._onsets_arr, time, side="right") - 1
+        if idx >= 0 and self._offsets_arr[idx] >= time:
+            return self._sorted_cells[idx]
+        return None
+
+    def _build_index(self):
+        """Sort cells by onset and cache their onset/offset arrays if stale."""
+
+        if (
+            not self._dirty
+            and self._indexed_cells is self.cells
+            and self._indexed_len == len(self.cells)
+        ):
+            return
+
+        n = len(self.cells)
+        if all(c._onsets is self._onsets for c in self.cells):
+            idx = np.fromiter((c._idx for c in self.cells), np.intp, n)
+            onsets = np.asarray(self._onsets, dtype=np.int64)[idx]
+            offsets = np.asarray(self._offsets, dtype=np.int64)[idx]
+        else:
+            # Cells created for another column keep their times in that
+            # column's buffers, and changing them does not mark this one stale.
+            onsets = np.fromiter((c.onset for c in self.cells), np.int64, n)
+            offsets = np.fromiter((c.offset for c in self.cells), np.int64, n)
+        order = np.argsort(onsets, kind="stable")
+
+        self._sorted_cells = [self.cells[i] for i in order.tolist()]
+        self._onsets_arr = onsets[order]
+        self._offsets_arr = offsets[order]
+        self._overlapping = bool(np.any(self._offsets_arr[:-1] >= self._onsets_arr[1:]))
+        self._dirty = False
+        self._indexed_cells = self.cells
+        self._indexed_len = len(self.cells)
 
     def values_at(self, time, intrinsics=False):
         cell = self.cell_at(time)
@@ -267,7 +454,7 @@ class Column:
             if intrinsics is True:
                 return cell.get_values(True)
             else:
-                return cell.values()
+                return cell.get_values()
 
     def __repr__(self):
         return (
@@ -282,25 +469,64 @@ class Column:
     def _to_opfdb(self):
         """Converts to .opf compatible string."""
 
+        return "\n".join(self._opfdb_lines())
+
+    def _opfdb_lines(self):
+        """Header line followed by one .opf line per cell."""
+
         header = (
             self.name
             + " (MATRIX,false,)-"
             + ",".join([str(c) + "|NOMINAL" for c in self.codelist])
         )
-        lst = [c._to_opfdb() for c in self.cells]
-        lst.insert(0, header)
-        return "\n".join(lst)
+        lines = [header]
+        lines.extend([c._to_opfdb() for c in self.cells])
+        return lines
 
 
-class Cell:
+class Cell(object):
     """Representation of a Datavyu annotation."""
 
+    # Code values are kept in a list parallel to parent.codelist. Onset and
+    # offset live at position _idx of the parent's time buffers, as whole
+    # milliseconds (non-integer times are rounded).
+    __slots__ = ("_parent", "_ordinal", "_onsets", "_offsets", "_idx", "values")
+
     def __init__(self, parent=None, ordinal=0, onset=0, offset=0):
         self._parent = parent
         self._ordinal = ordinal
-        self.onset = to_millis(onset)
-        self.offset = to_millis(offset)
-        self.values = {} if parent is None else {k: "" for k in parent.codelist}
+        self._store_times(
+            onset if isinstance(onset, int) else to_millis(onset),
+            offset if isinstance(offset, int) else to_millis(offset),
+        )
+        self.values = [] if parent is None else [""] * len(parent.codelist)
+
+    @classmethod
+    def _new_fast(cls, parent, ordinal, onset_ms, offset_ms):
+        """Build a cell from already converted millisecond times, with empty values."""
+
+        cell = cls.__new__(cls)
+        cell._parent = parent
+        cell._ordinal = ordinal
+        cell._store_times(onset_ms, offset_ms)
+        cell.values = [""] * len(parent.codelist)
+        return cell
+
+    def _store_times(self, onset, offset):
+        """Append the times to the parent's buffers, or to private ones if none."""
+
+        onset = _whole_millis(onset)
+        offset = _whole_millis(offset)
+        if self._parent is None:
+            self._onsets = array(_TIME_TYPECODE, [onset])
+            self._offsets = array(_TIME_TYPECODE, [offset])
+            self._idx = 0
+        else:
+            self._onsets = self._parent._onsets
+            self._offsets = self._parent._offsets
+            self._idx = len(self._onsets)
+            self._onsets.append(onset)
+            self._offsets.append(offset)
 
     def __repr__(self):
         return (
@@ -320,13 +546,14 @@ class Cell:
         if code == "ordinal":
             self._ordinal = value
         elif code == "onset":
-            self.onset = to_millis(value)
+            self.onset = value if isinstance(value, int) else to_millis(value)
         elif code == "offset":
-            self.offset = to_millis(value)
-        elif code in self.values.keys():
-            self.values[code] = value
+            self.offset = value if isinstance(value, int) else to_millis(value)
         else:
-            raise Exception("Cell does not have code: " + code)
+            try:
+                self.values[self.parent._code_index[code]] = value
+            except (AttributeError, KeyError):
+                raise Exception("Cell does not have code: " + code)
 
     def get_code(self, code):
         if code == "ordinal":
@@ -335,10 +562,11 @@ class Cell:
             return self.onset
         elif code == "offset":
             return self.offset
-        elif code in self.values.keys():
-            return self.values[code]
         else:
-            raise Exception("Cell does not contain code: " + code)
+            try:
+                return self.values[self.parent._code_index[code]]
+            except (AttributeError, KeyError):
+                raise Exception("Cell does not contain code: " + code)
 
     def set_values(self, *values):
         for code, value in zip(self.parent.codelist, values):
@@ -363,7 +591,7 @@ class Cell:
 
     def isempty(self):
         """ Return true if all code values are "" or null"""
-        return all(v == "" or v is None for v in self.values.values())
+        return all(v == "" or v is None for v in self.values)
 
     @property
     def parent(self):
@@ -373,18 +601,39 @@ class Cell:
     def ordinal(self):
         return self._ordinal
 
+    @property
+    def onset(self):
+        return self._onsets[self._idx]
+
+    @onset.setter
+    def onset(self, value):
+        self._onsets[self._idx] = _whole_millis(value)
+        if self._parent is not None:
+            self._parent._dirty = True
+
+    @property
+    def offset(self):
+        return self._offsets[self._idx]
+
+    @offset.setter
+    def offset(self, value):
+        self._offsets[self._idx] = _whole_millis(value)
+        if self._parent is not None:
+            self._parent._dirty = True
+
     def _to_opfdb(self):
-        return (
-            to_timestamp(self.onset)
-            + ","
-            + to_timestamp(self.offset)
-            + ","
-            + "("
-            + ",".join([v for v in self.get_values()])
-            + ")"
+        return "{},{},({})".format(
+            to_timestamp(self.onset), to_timestamp(self.offset), ",".join(self.values)
         )
 
 
+def _whole_millis(millis):
+    """Round a millisecond time to an int, half up."""
+    if isinstance(millis, int):
+        return millis
+    return int(floor(millis + 0.5))
+
+
 def to_millis(timestamp):
     if isinstance(timestamp, numbers.Number):
         return timestamp
@@ -398,6 +647,21 @@ def to_millis(timestamp):
     return ms
 
 
+def to_millis_bulk(timestamps):
+    """
+    Convert a sequence of HH:MM:SS:mmm timestamps to an array of milliseconds.
+    """
+
+    buf = "".join(timestamps).encode("ascii")
+    digits = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 12).astype(np.int64) - 48
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 3] * 10 + digits[:, 4]
+    seconds = digits[:, 6] * 10 + digits[:, 7]
+    millis = digits[:, 9] * 100 + digits[:, 10] * 10 + digits[:, 11]
+
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000 + millis
+
+
 def to_timestamp(millis):
     factors = [1000, 60, 60, 24]
     ms = millis
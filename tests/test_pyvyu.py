@@ -1,17 +1,18 @@
-import pyvyu as pv
+import py2vyu as pv
 import pandas as pd
 import logging as log
+import io
 import os
-import pkg_resources
+import zipfile
 import pytest
 
 
 def get_resource(file):
     """Get test resources. """
-    path = os.path.join("resources", file)
+    path = os.path.join(os.path.dirname(__file__), "resources", file)
 
-    if pkg_resources.resource_exists(__name__, path):
-        return pkg_resources.resource_stream(__name__, path)
+    if os.path.exists(path):
+        return open(path, "rb")
     else:
         raise (Exception(f"Can't find resource: {file}"))
 
@@ -33,6 +34,144 @@ def test_load_sample(sample_spreadsheet):
     assert len(momspeech.sorted_cells()) == 20
 
 
+def test_spreadsheets_do_not_share_columns(sample_spreadsheet):
+    sheet = pv.load_opf(sample_spreadsheet)
+    other = pv.Spreadsheet()
+    assert len(other.get_column_list()) == 0
+
+    other.new_column("Extra", "code")
+    assert "Extra" not in sheet.get_column_list()
+
+
+def test_cell_at(sample_spreadsheet):
+    sheet = pv.load_opf(sample_spreadsheet)
+    momspeech = sheet.get_column("MomSpeech")
+
+    for cell in momspeech.cells:
+        assert momspeech.cell_at(cell.onset) is cell
+        assert momspeech.cell_at(cell.offset) is cell
+
+    last = max(momspeech.cells, key=lambda x: x.offset)
+    assert momspeech.cell_at(last.offset + 1) is None
+
+    last.change_code("offset", last.offset + 10)
+    assert momspeech.cell_at(last.offset) is last
+
+    momspeech.cells.remove(last)
+    assert momspeech.cell_at(last.offset) is None
+
+    momspeech.cells = [last]
+    assert momspeech.cell_at(last.offset) is last
+
+
+def test_float_times():
+    col = pv.Column("c", "a")
+    cell = col.new_cell("x", onset=1000.0, offset=2000.5)
+    assert (cell.onset, cell.offset) == (1000, 2001)
+
+    cell.change_code("onset", 5.0)
+    assert cell.onset == 5
+    assert col.cell_at(5) is cell
+
+
+def opf_stream(*lines):
+    """In-memory .opf file whose db holds the given lines."""
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, "w") as zf:
+        zf.writestr("db", "\r\n".join(("#4",) + lines))
+    stream.seek(0)
+    return stream
+
+
+def test_load_padded_lines():
+    for line in [
+        "00:00:01:000,00:00:02:000,(hi) ",
+        "  00:00:01:000,00:00:02:000,(hi)",
+    ]:
+        sheet = pv.load_opf(opf_stream("Col (MATRIX,true,)-a|NOMINAL", line))
+        cells = sheet.get_column("Col").cells
+        assert len(cells) == 1
+        assert cells[0].get_values() == ["hi"]
+
+
+def test_load_embedded_carriage_return():
+    sheet = pv.load_opf(
+        opf_stream(
+            "Col (MATRIX,true,)-a|NOMINAL,b|NOMINAL",
+            "00:00:01:000,00:00:02:000,(he\rllo,x)",
+        )
+    )
+    cells = sheet.get_column("Col").cells
+    assert [c.get_values() for c in cells] == [["he\rllo", "x"]]
+
+
+def test_load_skips_bad_timestamps():
+    sheet = pv.load_opf(
+        opf_stream(
+            "Col (MATRIX,true,)-a|NOMINAL",
+            "ab:00:01:000,00:00:02:000,(letters)",
+            "00:00:01:000,00:\u00e9\u00e9:02:000,(accents)",
+            "00:00:01:000,00:00:02:000,(ok)",
+        )
+    )
+    cells = sheet.get_column("Col").cells
+    assert [c.get_values() for c in cells] == [["ok"]]
+
+
+def test_cell_at_foreign_cell():
+    col = pv.Column("c", "a")
+    col.new_cell("x", onset=0, offset=10)
+    other = pv.Column("o", "a")
+    other.new_cell("y", onset=500, offset=600)
+    foreign = other.new_cell("z", onset=20, offset=30)
+
+    col.cells.append(foreign)
+    assert col.cell_at(25) is foreign
+    assert col.cell_at(550) is None
+
+
+@pytest.fixture
+def merge_sheet():
+    """Two small columns: A has overlapping cells, B has a point cell."""
+    sheet = pv.Spreadsheet()
+    a = sheet.new_column("A", "x")
+    a.new_cell("a1", ordinal=1, onset=0, offset=100)
+    a.new_cell("a2", ordinal=2, onset=50, offset=150)
+    b = sheet.new_column("B", "y")
+    b.new_cell("b0", ordinal=1, onset=0, offset=19)
+    b.new_cell("p", ordinal=2, onset=20, offset=20)
+    b.new_cell("b2", ordinal=3, onset=200, offset=300)
+    return sheet
+
+
+def test_merge_columns(merge_sheet):
+    merged = merge_sheet.merge_columns("m", True, "A", "B")
+    assert merged.codelist == ["A_ordinal", "A_x", "B_ordinal", "B_y"]
+    assert [c.get_values(True) for c in merged.cells] == [
+        [1, 0, 19, 1, "a1", 1, "b0"],
+        [2, 20, 20, 1, "a1", 2, "p"],
+        [3, 21, 21, 1, "a1", "", ""],
+        [4, 22, 50, 1, "a1", "", ""],
+        [5, 51, 100, 1, "a1", "", ""],
+        [6, 101, 150, 2, "a2", "", ""],
+        [7, 201, 300, "", "", 3, "b2"],
+    ]
+
+
+def test_merge_columns_no_prune(merge_sheet):
+    merged = merge_sheet.merge_columns("m", False, "A", "B")
+    assert [c.get_values(True) for c in merged.cells] == [
+        [1, 0, 19, 1, "a1", 1, "b0"],
+        [2, 20, 20, 1, "a1", 2, "p"],
+        [3, 21, 21, 1, "a1", "", ""],
+        [4, 22, 50, 1, "a1", "", ""],
+        [5, 51, 100, 1, "a1", "", ""],
+        [6, 101, 150, 2, "a2", "", ""],
+        [7, 151, 200, "", "", "", ""],
+        [8, 201, 300, "", "", 3, "b2"],
+    ]
+
+
 def test_spreadsheet_to_df(sample_spreadsheet):
     sheet = pv.load_opf(sample_spreadsheet)
     df = sheet.to_df()
@@ -103,3 +242,7 @@ def test_to_millis(rsrc_millis, rsrc_timestamps):
 def test_to_timestamp(rsrc_millis, rsrc_timestamps):
     for m, t in zip(rsrc_millis, rsrc_timestamps):
         assert t == pv.to_timestamp(m)
+
+
+def test_to_millis_bulk(rsrc_millis, rsrc_timestamps):
+    assert rsrc_millis == pv.to_millis_bulk(rsrc_timestamps).tolist()